@@ -5,11 +5,12 @@ from uuid import uuid4
 import re
 
 
-from db_utils import load_conversation_history_from_gcs
+from db_utils import load_conversation_history_from_gcs, optimize_image_bytes
 
 # --- MODIFIED: Import all necessary db_utils functions ---
 from db_utils import (
-    load_escalations_gsheet,
+    load_pending_escalations_gsheet,
+    prefetch_escalations_gsheet,
     mark_escalation_as_done_gsheet,
     submit_solution_for_review_db
 )
@@ -20,6 +21,9 @@ CACHE_DIR = BASE_DIR / "cache"
 SOLUTION_IMG_DIR = CACHE_DIR / "solution_images"
 os.makedirs(SOLUTION_IMG_DIR, exist_ok=True)
 
+# Kick off the Google Sheets download now so it overlaps with the page setup below
+escalations_future = prefetch_escalations_gsheet()
+
 # --- PAGE SETUP ---
 st.set_page_config(page_title="Advisor Panel", layout="wide")
 st.title("👨‍🏫 Advisor Panel: Knowledge Base Management")
@@ -42,9 +46,8 @@ def upload_image_to_gcs(image_file, filename: str):
         object_name = f"solution_images/{filename}"
         blob = bucket.blob(object_name)
 
-        # Upload the file
-        image_file.seek(0)  # Go to the beginning of the file
-        blob.upload_from_file(image_file)
+        # Upload a downscaled WEBP instead of the raw file
+        blob.upload_from_string(optimize_image_bytes(image_file), content_type="image/webp")
 
         # Return the public URL
         return blob.public_url
@@ -55,8 +58,7 @@ def upload_image_to_gcs(image_file, filename: str):
 
 # --- CORRECTED: Load pending escalations from Google Sheets ---
 try:
-    all_escalations = load_escalations_gsheet()
-    pending_escalations = [row for row in all_escalations if row.get("status") == "pending"]
+    pending_escalations = load_pending_escalations_gsheet(escalations_future)
 except Exception as e:
     st.error(f"Could not connect to Google Sheets. Please check secrets/sharing. Error: {e}")
     pending_escalations = []
@@ -86,18 +88,18 @@ with tab1:
                 history = load_conversation_history_from_gcs(ticket_id)
                 if history:
                     with st.expander("View Full Conversation History"):
+                        lines = []
                         for msg in history:
                             role = msg.get("role", "unknown").capitalize()
                             content = msg.get("content", "")
-                            if role == "User":
-                                st.markdown(f"👤 **{role}:** {content}")
-                            else:
-                                st.markdown(f"🤖 **{role}:** {content}")
+                            icon = "👤" if role == "User" else "🤖"
+                            lines.append(f"{icon} **{role}:** {content}")
+                        st.markdown("\n\n".join(lines))
+            query_numbers = re.findall(r'\d+', str(selected_row['query']))
+
             with st.form("resolve_form"):
-                # REPLACE the line above with this corrected version
                 message_number = st.text_input("Message Number*",
-                                               value=re.findall(r'\d+', str(selected_row['query']))[0] if re.findall(
-                                                   r'\d+', str(selected_row['query'])) else "")
+                                               value=query_numbers[0] if query_numbers else "")
                 message_text = st.text_area("Message Text*", value=selected_row['query'])
                 location = st.text_input("Location / Screen")
                 reason = st.text_area("Reason*")
@@ -114,8 +116,7 @@ with tab1:
                     else:
                         image_path = None
                         if solution_image is not None:
-                            file_extension = solution_image.name.split('.')[-1]
-                            unique_filename = f"sol_{message_number.strip()}_{uuid4().hex[:6]}.{file_extension}"
+                            unique_filename = f"sol_{message_number.strip()}_{uuid4().hex[:6]}.webp"
                             image_path = upload_image_to_gcs(solution_image, unique_filename)
 
                         new_solution_entry = {
@@ -164,8 +165,7 @@ with tab2:
             else:
                 image_path = None
                 if solution_image is not None:
-                    file_extension = solution_image.name.split('.')[-1]
-                    unique_filename = f"sol_{message_number.strip()}_{uuid4().hex[:6]}.{file_extension}"
+                    unique_filename = f"sol_{message_number.strip()}_{uuid4().hex[:6]}.webp"
                     # Call the new GCS upload function
                     image_path = upload_image_to_gcs(solution_image, unique_filename)
 
@@ -15,6 +15,7 @@ from langchain.memory import ConversationBufferMemory
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 from db_utils import search_errors_db, log_escalation_gsheet
+from embeddings import load_kb_with_embeddings
 import csv
 from io import StringIO
 from datetime import datetime, timezone
@@ -404,9 +405,8 @@ def load_all_guides():
     for name, path in kb_paths.items():
         if path.exists():
             try:
-                with open(path, "r", encoding="utf-8") as f:
-                    st.session_state.guide_kbs[name] = json.load(f)
-                    print(f"Successfully loaded {name} guide KB.")
+                st.session_state.guide_kbs[name] = load_kb_with_embeddings(path)
+                print(f"Successfully loaded {name} guide KB.")
             except Exception as e:
                 print(f"Error loading {name} guide KB: {e}")
                 st.session_state.guide_kbs[name] = []
@@ -1644,8 +1644,7 @@ def build_gl_guide_kb(pdf_path: str) -> bool:
 def load_gl_guide_kb() -> bool:
     if GUIDE_KB_PATH.exists():
         try:
-            with open(GUIDE_KB_PATH, "r", encoding="utf-8") as f:
-                st.session_state.gl_guide_kb = json.load(f)
+            st.session_state.gl_guide_kb = load_kb_with_embeddings(GUIDE_KB_PATH)
             return True
         except Exception:
             return False
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+One-time export of the MiniLM encoder to ONNX with dynamic int8 quantization.
+
+Writes onnx/model_quantized.onnx plus the tokenizer files; embeddings.load_sentence_model()
+picks it up automatically afterwards. Requires `optimum[onnxruntime]`.
+"""
+import sys
+
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+from embeddings import MODEL_NAME, ONNX_DIR, ONNX_MODEL_FILE
+
+HF_MODEL_ID = f"sentence-transformers/{MODEL_NAME}"
+
+
+def main():
+    print(f"--- Exporting {HF_MODEL_ID} to ONNX ---")
+    model = ORTModelForFeatureExtraction.from_pretrained(HF_MODEL_ID, export=True)
+    tokenizer = AutoTokenizer.from_pretrained(HF_MODEL_ID)
+    model.save_pretrained(ONNX_DIR)
+    tokenizer.save_pretrained(ONNX_DIR)
+
+    print("--- Quantizing to int8 (dynamic, AVX-512 VNNI) ---")
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=ONNX_DIR, quantization_config=qconfig)
+
+    print(f"\n✅ Wrote {ONNX_DIR / ONNX_MODEL_FILE}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
 from uuid import uuid4
 
+import io
+import json
+import os
+import threading
 import streamlit as st
 import chromadb
-from chromadb.utils import embedding_functions
-from sentence_transformers import SentenceTransformer
 import gspread
+from gspread.utils import rowcol_to_a1
 import re
+from cachetools import TTLCache
+from PIL import Image, ImageOps
 
 from datetime import datetime, timezone
 
+from embeddings import SentenceModelEmbeddingFunction, open_collection
+
 # --- CONSTANTS ---
 LIVE_KB_COLLECTION = "live_errors_kb"
 PENDING_KB_COLLECTION = "pending_errors_kb"
+IMAGE_MAX_SIDE = 1024  # stored solution images are downscaled to fit this box
+THUMB_MAX_SIDE = 300  # matches the width=300 previews in the admin panel
+CHROMA_PAGE_SIZE = 1000  # records per get() when scanning a whole collection
 
+# First 3+ digit run in a query is treated as a candidate message number
+_DIGITS_RE = re.compile(r'\d{3,}')
 
-# --- EMBEDDING MODEL (Cached) ---
-@st.cache_resource
-def get_embedding_model():
-    return SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+# Direct message-number hits from search_errors_db, so repeated lookups skip Chroma Cloud.
+# TTLCache isn't thread-safe and every Streamlit session runs on its own thread.
+_id_cache = TTLCache(maxsize=1024, ttl=600)
+_id_cache_lock = threading.Lock()
+# Semantic search results, keyed by (query, n_results). The TTL bounds how long approvals made in
+# another process (admin_app) take to show up here; approvals in this process clear it at once.
+_query_cache = TTLCache(maxsize=256, ttl=300)
+_query_cache_lock = threading.Lock()
+
+# Shared worker pool for network prefetches; lives as long as the process
+_prefetch_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="db_prefetch")
+# Disk writes for uploaded images, so form submits don't wait on IO
+_io_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image_io")
 
 
 # --- CHROMA DB CLIENT ---
@@ -39,27 +62,32 @@ def get_chroma_client():
 
 
 @st.cache_resource
-def get_embedding_function():
-    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name='paraphrase-multilingual-MiniLM-L12-v2')
+def get_embedding_function(normalize: bool = True):
+    """
+    Unit-length vectors for inner-product collections; raw ones for collections still on the old
+    l2 space, so new approvals and queries match what is already stored there.
+    Both variants share the one model picked by embeddings.load_sentence_model (EMBEDDING_BACKEND).
+    """
+    return SentenceModelEmbeddingFunction(normalize)
+
+
+# Collection handles are cached so Chroma Cloud is only asked for them once per process.
+@st.cache_resource
+def get_collection(name: str):
+    collection, _ = open_collection(get_chroma_client(), name, get_embedding_function)
+    return collection
 
 
 def get_collections():
-    client = get_chroma_client()
-    embedding_func = get_embedding_function()
-    live_collection = client.get_or_create_collection(name=LIVE_KB_COLLECTION, embedding_function=embedding_func)
-    pending_collection = client.get_or_create_collection(name=PENDING_KB_COLLECTION, embedding_function=embedding_func)
-    return live_collection, pending_collection
+    return get_live_kb_collection(), get_pending_kb_collection()
 
 
 def get_live_kb_collection():
-    client = get_chroma_client()
-    embedding_func = get_embedding_function()
-    return client.get_or_create_collection(name=LIVE_KB_COLLECTION, embedding_function=embedding_func)
+    return get_collection(LIVE_KB_COLLECTION)
+
 
 def get_pending_kb_collection():
-    client = get_chroma_client()
-    embedding_func = get_embedding_function()
-    return client.get_or_create_collection(name=PENDING_KB_COLLECTION, embedding_function=embedding_func)
+    return get_collection(PENDING_KB_COLLECTION)
 
 
 # --- GOOGLE SHEETS CLIENT ---
@@ -67,52 +95,171 @@ def get_pending_kb_collection():
 def get_gsheet():
     gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
     sheet = gc.open(st.secrets["GSHEET_NAME"]).sheet1
-    if not sheet.get_all_values():
+    # Probe the first cell instead of downloading the whole log to see if a header is needed
+    if not sheet.acell("A1").value:
         sheet.append_row(["ticket_id", "timestamp_utc", "query", "reason", "status"])
     return sheet
 
 
 
+# --- IMAGES ---
+def _open_image(file_obj):
+    file_obj.seek(0)
+    img = ImageOps.exif_transpose(Image.open(file_obj))
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if img.mode in ("LA", "P") else "RGB")
+    return img
+
+
+def _encode_webp(img, max_side: int) -> bytes:
+    img = img.copy()
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, "WEBP", quality=82, method=4)
+    return buf.getvalue()
+
+
+def optimize_image_bytes(file_obj) -> bytes:
+    """Re-encodes an uploaded image as a WEBP no larger than IMAGE_MAX_SIDE."""
+    return _encode_webp(_open_image(file_obj), IMAGE_MAX_SIDE)
+
+
+def save_optimized_image(file_obj, dest_path_noext) -> str:
+    """Writes `<dest>.webp` plus a `<dest>_thumb.webp` preview and returns the full-size path."""
+    img = _open_image(file_obj)
+    dest = str(dest_path_noext)
+    Path(dest + ".webp").write_bytes(_encode_webp(img, IMAGE_MAX_SIDE))
+    Path(dest + "_thumb.webp").write_bytes(_encode_webp(img, THUMB_MAX_SIDE))
+    return dest + ".webp"
+
+
+def thumbnail_path(image_path, existing_names=None):
+    """
+    Returns the _thumb.webp sibling of a locally saved image if it exists, else the path unchanged.
+    Pass `existing_names` (file names in the image folder) to check membership instead of stat-ing.
+    """
+    if image_path and image_path.endswith(".webp"):
+        thumb = image_path[:-len(".webp")] + "_thumb.webp"
+        if existing_names is not None:
+            thumb_exists = Path(thumb).name in existing_names
+        else:
+            thumb_exists = os.path.exists(thumb)
+        if thumb_exists:
+            return thumb
+    return image_path
+
+
+# --- BACKGROUND IO ---
+def save_uploaded_image_async(uploaded_file, dest_path_noext) -> str:
+    """
+    Optimizes and writes an uploaded image on the IO pool and returns the path it will have.
+    The Future is reaped by reap_pending_io().
+    """
+    # UploadedFile is already an in-memory BytesIO, so hand it over as-is rather than copying its bytes
+    future = _io_pool.submit(save_optimized_image, uploaded_file, dest_path_noext)
+    if "pending_io" not in st.session_state:
+        st.session_state.pending_io = []
+    st.session_state.pending_io.append(future)
+    return str(dest_path_noext) + ".webp"
+
+
+def reap_pending_io(timeout: float = 5.0):
+    """
+    Waits (up to `timeout` seconds) for image writes started on earlier reruns and reports any that
+    failed. Call it before listing the image folder: a Save reruns right away, usually before its
+    write has finished, and the new image would otherwise be listed as missing.
+    """
+    pending = st.session_state.get("pending_io")
+    if not pending:
+        return
+    done, not_done = wait(pending, timeout=timeout)
+    for future in done:
+        if future.exception():
+            st.error(f"Failed to save image: {future.exception()}")
+    st.session_state.pending_io = list(not_done)
+
+
 # --- DATABASE FUNCTIONS ---
-def submit_solution_for_review_db(new_entry: dict):
-    """Adds or UPDATES a solution in the pending review collection using upsert."""
+def _invalidate_pending_solutions():
+    """Bumps the pending-list version so the next rerun refetches from Chroma."""
+    st.session_state.pending_version = st.session_state.get("pending_version", 0) + 1
+    # Other sessions share the cache, so drop it instead of waiting for the TTL.
+    _load_pending_solutions_cached.clear()
+
+
+def batch_submit_for_review(entries: list[dict]):
+    """
+    Adds or UPDATES several solutions in the pending review collection with one upsert call.
+    Entries are written when called rather than buffered per session: a buffered submission would be
+    lost with the session and stay invisible to the admin review queue until flushed.
+    """
+    if not entries:
+        return
     pending_collection = get_pending_kb_collection()
 
-    # Use the existing review_id if this is an update, or create a new one if it's a new entry.
-    review_id = new_entry.get("review_id") or f"review_{uuid4().hex[:8]}"
+    ids, metadatas, documents = [], [], []
+    for entry in entries:
+        # Use the existing review_id if this is an update, or create a new one if it's a new entry.
+        review_id = entry.get("review_id") or f"review_{uuid4().hex[:8]}"
+
+        clean_metadata = {k: v for k, v in entry.items() if v is not None}
+        # Ensure review_id is in the metadata for consistency
+        clean_metadata['review_id'] = review_id
 
-    document_text = f"Error {new_entry.get('message_number', '')}: {new_entry.get('message_text', '')}"
-    clean_metadata = {k: v for k, v in new_entry.items() if v is not None}
-    # Ensure review_id is in the metadata for consistency
-    clean_metadata['review_id'] = review_id
+        ids.append(review_id)
+        metadatas.append(clean_metadata)
+        documents.append(f"Error {entry.get('message_number', '')}: {entry.get('message_text', '')}")
 
     # --- THIS IS THE FIX ---
     # Use upsert() to either create a new entry or update an existing one based on the ID.
-    pending_collection.upsert(
-        ids=[review_id],
-        metadatas=[clean_metadata],
-        documents=[document_text]
-    )
+    pending_collection.upsert(ids=ids, metadatas=metadatas, documents=documents)
+    _invalidate_pending_solutions()
+
+
+def submit_solution_for_review_db(new_entry: dict):
+    """Adds or UPDATES a solution in the pending review collection using upsert."""
+    batch_submit_for_review([new_entry])
+
+
 def approve_solution_db(solution: dict):
     live_collection, pending_collection = get_collections()
     review_id = solution.pop("review_id", None)
 
-    model = get_embedding_model()
     text_to_embed = f"{solution.get('message_text', '')} {solution.get('reason', '')}"
-    embedding = model.encode(text_to_embed).tolist()
 
+    # The collection's embedding function encodes the document, so no second model copy is loaded here.
     live_collection.add(
         ids=[str(solution["message_number"])],
-        embeddings=[embedding],
+        documents=[text_to_embed],
         metadatas=[solution]
     )
     if review_id:
         pending_collection.delete(ids=[review_id])
+    _invalidate_pending_solutions()
+    with _query_cache_lock:
+        _query_cache.clear()  # The new entry may now be the best semantic match
+    with _id_cache_lock:
+        _id_cache.pop(str(solution["message_number"]), None)
 
 
 def reject_solution_db(review_id: str):
     _, pending_collection = get_collections()
     pending_collection.delete(ids=[review_id])
+    _invalidate_pending_solutions()
+
+
+def _cached_query(query_text: str, n_results: int):
+    """Semantic search memoized per process for a few minutes; cleared when this process approves."""
+    key = (query_text, n_results)
+    with _query_cache_lock:
+        results = _query_cache.get(key)
+    if results is None:
+        # Callers only read metadatas/distances, so don't pull documents back over the wire
+        results = get_live_kb_collection().query(query_texts=[query_text], n_results=n_results,
+                                                 include=["metadatas", "distances"])
+        with _query_cache_lock:
+            _query_cache[key] = results
+    return results
 
 
 def search_errors_db(query: str, n_results: int = 1):
@@ -125,43 +272,102 @@ def search_errors_db(query: str, n_results: int = 1):
 
     # --- NEW: Smart number extraction ---
     # First, try to find a 3+ digit number within the query string.
-    numbers_found = re.findall(r'\d{3,}', cleaned_query)
-    if numbers_found:
-        number_id = numbers_found[0]
+    number_match = _DIGITS_RE.search(cleaned_query)
+    if number_match:
+        number_id = number_match.group(0)
+        with _id_cache_lock:
+            cached_metadata = _id_cache.get(number_id)
+        if cached_metadata is not None:
+            return {"metadatas": [[cached_metadata]], "distances": [[0.0]]}
+
         # Try a direct lookup using the found number as an ID.
         result = live_collection.get(ids=[number_id], include=["metadatas"])
         if result and result.get('ids'):
             print(f"--- DEBUG: Found direct match for ID '{number_id}' in query. ---")
+            with _id_cache_lock:
+                _id_cache[number_id] = result['metadatas'][0]
             # Format the result to match the structure of a query() result
             return {"metadatas": [result['metadatas']], "distances": [[0.0]]}
     # --- END of new logic ---
 
     # If no number was found, or if the direct ID lookup failed, perform a full semantic search.
     print(f"--- DEBUG: No direct ID match found. Performing semantic search for '{query}'. ---")
-    results = live_collection.query(query_texts=[query], n_results=n_results)
+    results = _cached_query(cleaned_query, n_results)
 
     return results if results and results.get('ids') and results['ids'][0] else None
 # In db_utils.py
 
+def _get_all_metadatas(collection, page_size: int = CHROMA_PAGE_SIZE):
+    """Reads every (id, metadata) from a collection in limit/offset pages."""
+    ids, metadatas = [], []
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        page_ids = page.get('ids') or []
+        ids.extend(page_ids)
+        metadatas.extend(page.get('metadatas') or [])
+        if len(page_ids) < page_size:
+            return ids, metadatas
+        offset += page_size
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _load_pending_solutions_cached(version: int):
+    """Cached pending-collection scan; `version` only exists to key the cache."""
+    ids, metadatas = _get_all_metadatas(get_pending_kb_collection())
+    # Return a list of (id, metadata) tuples
+    return list(zip(ids, metadatas))
+
+
 def load_pending_solutions_db():
     """Fetches all items from the pending collection, returning both IDs and metadata."""
-    pending_collection = get_pending_kb_collection()
-    results = pending_collection.get()
-    # Return a list of (id, metadata) tuples
-    if results and results.get('ids'):
-        return list(zip(results['ids'], results.get('metadatas', [])))
-    return []
+    return _load_pending_solutions_cached(st.session_state.get("pending_version", 0))
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _load_all_errors_cached(count: int):
+    """Cached live-KB scan; keyed on the collection size so additions show up immediately."""
+    _, metadatas = _get_all_metadatas(get_live_kb_collection())
+    return metadatas
 
 
 def load_all_errors_db():
     """Fetches all items from the live KB collection."""
     live_collection = get_live_kb_collection()
-    # The include parameter ensures we get everything we need.
-    results = live_collection.get(include=["metadatas"])
-    return results.get('metadatas', [])
+    # count() is a tiny request; the full scan only reruns when the size changes or the TTL expires
+    return _load_all_errors_cached(live_collection.count())
+
+
 def log_escalation_gsheet(ticket_id: str, query: str, reason: str):
     sheet = get_gsheet()
     sheet.append_row([ticket_id, datetime.now(timezone.utc).isoformat(), query, reason, "pending"])
+    _fetch_escalation_rows.clear()
+
+
+@st.cache_resource
+def get_gcs_bucket():
+    """Builds the GCS client once per process and returns the escalation-logs bucket."""
+    from google.cloud import storage
+    from google.oauth2 import service_account
+
+    creds_info = st.secrets["gcp_service_account"]
+    creds = service_account.Credentials.from_service_account_info(creds_info)
+    client = storage.Client(credentials=creds, project=creds.project_id)
+
+    bucket_name = st.secrets["gcs"]["bucket_name"]
+    if not bucket_name:
+        return None
+    return client.bucket(bucket_name)
+
+
+def _download_history(bucket, ticket_id: str):
+    """Fetches one history blob. Runs on worker threads, so no st.* calls here."""
+    object_name = f"escalation_logs/{ticket_id}.json"
+    blob = bucket.blob(object_name)
+    if blob.exists():
+        return json.loads(blob.download_as_string())
+    print(f"History file not found in GCS: {object_name}")
+    return None
 
 
 def load_conversation_history_from_gcs(ticket_id: str):
@@ -169,39 +375,122 @@ def load_conversation_history_from_gcs(ticket_id: str):
     if not ticket_id:
         return None
     try:
-        from google.cloud import storage
-        from google.oauth2 import service_account
-        import json  # Make sure json is imported
-
-        creds_info = st.secrets["gcp_service_account"]
-        creds = service_account.Credentials.from_service_account_info(creds_info)
-        client = storage.Client(credentials=creds, project=creds.project_id)
-
-        bucket_name = st.secrets["gcs"]["bucket_name"]
-        if not bucket_name: return None
-
-        bucket = client.bucket(bucket_name)
-        object_name = f"escalation_logs/{ticket_id}.json"
+        bucket = get_gcs_bucket()
+        if bucket is None: return None
+        return _download_history(bucket, ticket_id)
+    except Exception as e:
+        st.error(f"Failed to load chat history from GCS: {e}")
+        return None
 
-        blob = bucket.blob(object_name)
-        if blob.exists():
-            history_json = blob.download_as_string()
-            return json.loads(history_json)
-        else:
-            print(f"History file not found in GCS: {object_name}")
-            return None
 
+def prefetch_histories(ticket_ids: list[str]) -> dict[str, list]:
+    """
+    Downloads several chat histories from GCS in parallel, keyed by ticket_id.
+    A confirmed missing file maps to None; failed downloads are left out so the caller retries them.
+    """
+    ticket_ids = [t for t in dict.fromkeys(ticket_ids) if t]
+    if not ticket_ids:
+        return {}
+    try:
+        bucket = get_gcs_bucket()
     except Exception as e:
         st.error(f"Failed to load chat history from GCS: {e}")
+        return {}
+    if bucket is None:
+        return {}
+
+    futures = {tid: _prefetch_pool.submit(_download_history, bucket, tid) for tid in ticket_ids}
+    histories = {}
+    for tid, future in futures.items():
+        try:
+            histories[tid] = future.result()
+        except Exception as e:
+            print(f"Failed to prefetch history for {tid}: {e}")
+    return histories
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_escalation_rows():
+    """
+    Raw sheet values, cached so advisor reruns don't hit the Sheets API every time.
+    get_all_values() skips the per-cell type coercion that get_all_records() does.
+    """
+    sheet = get_gsheet()
+    return sheet.get_all_values()
+
+
+def prefetch_escalations_gsheet():
+    """Starts the sheet download on a worker thread; pass the Future to load_pending_escalations_gsheet()."""
+    return _prefetch_pool.submit(_fetch_escalation_rows)
+
+
+def load_pending_escalations_gsheet(prefetched=None):
+    """Returns the 'pending' escalations as dicts and indexes their sheet rows by ticket_id."""
+    rows = prefetched.result() if prefetched is not None else _fetch_escalation_rows()
+    if not rows:
+        return []
+    headers = rows[0]
+    status_col = headers.index("status")
+
+    pending, row_index = [], {}
+    # Row 1 is the header, so data starts on sheet row 2
+    for row_number, values in enumerate(rows[1:], start=2):
+        if len(values) > status_col and values[status_col] == "pending":
+            record = dict(zip(headers, values))
+            pending.append(record)
+            row_index[str(record.get("ticket_id"))] = row_number
+    st.session_state.ticket_row_index = row_index
+    st.session_state.ticket_status_col = status_col + 1  # 1-based, for mark_escalation_as_done_gsheet
+    return pending
+
+
+def _find_escalation_row(ticket_id: str):
+    """Looks the ticket up in the cached sheet download (any status) before resorting to sheet.find()."""
+    rows = _fetch_escalation_rows()
+    if not rows or "ticket_id" not in rows[0]:
         return None
+    id_col = rows[0].index("ticket_id")
+    for row_number, values in enumerate(rows[1:], start=2):
+        if len(values) > id_col and values[id_col] == str(ticket_id):
+            return row_number
+    return None
 
-def load_escalations_gsheet():
-    sheet = get_gsheet()
-    return sheet.get_all_records()
+
+def _status_column() -> int:
+    """1-based column of the 'status' header, from the same header lookup the reader uses."""
+    col = st.session_state.get("ticket_status_col")
+    if col is None:
+        headers = (_fetch_escalation_rows() or [[]])[0]
+        col = headers.index("status") + 1
+    return col
 
 
 def mark_escalation_as_done_gsheet(ticket_id: str):
-    sheet = get_gsheet()
-    cell = sheet.find(ticket_id)
-    if cell:
-        sheet.update_cell(cell.row, 5, "done")  # Column 5 is 'status'
+    """
+    Writes the status straight to the sheet so it survives the session and other advisors see it.
+    The row comes from the cached index, so this is one batch_update instead of find() + update_cell().
+    """
+    row = st.session_state.get("ticket_row_index", {}).get(str(ticket_id)) or _find_escalation_row(ticket_id)
+    if row is None:
+        cell = get_gsheet().find(ticket_id)
+        if not cell:
+            return
+        row = cell.row
+
+    status_cell = rowcol_to_a1(row, _status_column())
+    get_gsheet().batch_update([{"range": status_cell, "values": [["done"]]}])
+    _fetch_escalation_rows.clear()
+
+
+# --- MODEL WARMUP ---
+def _warm_up_embedding_model():
+    try:
+        get_embedding_function()([""])
+    except Exception as e:
+        print(f"Embedding model warmup failed: {e}")
+
+
+# Load the embedding weights in the background at import time so the first search/approval
+# doesn't pay for it. Set DISABLE_EMBEDDING_WARMUP=1 to skip (e.g. in tests).
+if not os.getenv("DISABLE_EMBEDDING_WARMUP"):
+    threading.Thread(target=_warm_up_embedding_model, name="embedding_warmup", daemon=True).start()
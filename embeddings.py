@@ -0,0 +1,230 @@
+"""
+Shared loader for the multilingual MiniLM sentence encoder.
+
+Kept free of Streamlit so both the apps and the headless migration scripts can use it.
+"""
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import orjson
+from chromadb import EmbeddingFunction
+
+MODEL_NAME = "paraphrase-multilingual-MiniLM-L12-v2"
+# CT2SentenceTransformer takes the original hub id and converts it to CTranslate2 itself;
+# int8 on CPU is ~2-5x faster with half the RAM
+CT2_MODEL_NAME = f"sentence-transformers/{MODEL_NAME}"
+
+# Written by convert.py: ONNX export + dynamic int8 quantization of the same model
+ONNX_DIR = Path(__file__).parent / "onnx"
+ONNX_MODEL_FILE = "model_quantized.onnx"
+MAX_SEQ_LENGTH = 128  # matches the SentenceTransformer config for this model
+
+# New Chroma collections hold L2-normalized vectors ranked by inner product, which orders like cosine
+# without a per-candidate norm. Collections created before this keep the default l2 space over raw
+# vectors until migrate.py --recreate rebuilds them, so every writer checks before normalizing.
+COLLECTION_METADATA = {"hnsw:space": "ip"}
+
+# Guide KBs keep topic metadata in JSON and embeddings in a float16 (N, dim) matrix next to it
+EMBEDDING_SIDECAR_SUFFIX = ".emb.npy"
+
+
+class OnnxSentenceEncoder:
+    """
+    Runs the quantized ONNX export with onnxruntime and mean-pools token embeddings,
+    mirroring SentenceTransformer's `.encode()` for the arguments this repo uses.
+    """
+
+    def __init__(self, model_dir: Path = ONNX_DIR):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self.session = ort.InferenceSession(str(model_dir / ONNX_MODEL_FILE), providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        chunks = []
+        for start in range(0, len(sentences), batch_size):
+            batch = self.tokenizer(sentences[start:start + batch_size], padding=True, truncation=True,
+                                   max_length=MAX_SEQ_LENGTH, return_tensors="np")
+            feeds = {k: v.astype(np.int64) for k, v in batch.items() if k in self._input_names}
+            token_embeddings = self.session.run(None, feeds)[0]
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            chunks.append((token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+
+        embeddings = np.concatenate(chunks).astype(np.float32)
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
+
+
+def onnx_model_available() -> bool:
+    return (ONNX_DIR / ONNX_MODEL_FILE).exists()
+
+
+def load_sentence_model():
+    """
+    Returns an object with the SentenceTransformer `.encode()` API.
+
+    EMBEDDING_BACKEND picks the runtime: "onnx", "ct2", "st", or "auto" (default), which
+    uses the quantized ONNX export if convert.py has been run, then the CTranslate2 int8
+    build if `hf_hub_ctranslate2` is installed, and finally the regular SentenceTransformer.
+    A CTranslate2 build that fails to load also falls back to the regular SentenceTransformer.
+    """
+    backend = os.getenv("EMBEDDING_BACKEND", "auto").lower()
+
+    if backend == "onnx" or (backend == "auto" and onnx_model_available()):
+        return OnnxSentenceEncoder()
+
+    if backend in ("ct2", "auto"):
+        try:
+            from hf_hub_ctranslate2 import CT2SentenceTransformer
+            return CT2SentenceTransformer(CT2_MODEL_NAME, compute_type="int8", device="cpu")
+        except ImportError:
+            pass
+        except Exception as e:
+            print(f"CTranslate2 model failed to load, using SentenceTransformer instead: {e}")
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(MODEL_NAME)
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_sentence_model():
+    """Process-wide lazy singleton around load_sentence_model(), safe to call from any thread."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_sentence_model()
+    return _model
+
+
+# --- CHROMA COLLECTIONS ---
+class SentenceModelEmbeddingFunction(EmbeddingFunction):
+    """
+    Chroma embedding function over get_sentence_model(), so the apps query and append with the
+    same runtime (ONNX, CTranslate2 or SentenceTransformer) the migration scripts wrote with.
+    """
+
+    def __init__(self, normalize: bool = True):
+        self._normalize = normalize
+
+    def __call__(self, input):
+        return get_sentence_model().encode(list(input), convert_to_numpy=True,
+                                           normalize_embeddings=self._normalize).tolist()
+
+
+def is_unit_vector_collection(collection) -> bool:
+    return (collection.metadata or {}).get("hnsw:space") == "ip"
+
+
+def collection_not_found_errors() -> tuple:
+    """
+    What get_collection raises for a missing collection: NotFoundError on chromadb 1.x,
+    InvalidCollectionException on 0.6. Anything else (network, auth, quota) must propagate,
+    or an existing l2 collection would be treated as new and queried with unit vectors.
+    """
+    from chromadb import errors
+
+    return tuple(getattr(errors, name) for name in ("NotFoundError", "InvalidCollectionException")
+                 if hasattr(errors, name))
+
+
+def open_collection(client, name: str, embedding_function_for=None):
+    """
+    Opens a collection, creating it with COLLECTION_METADATA if it doesn't exist yet.
+    Returns (collection, normalize): whether vectors written to or queried against it must be unit-length.
+    embedding_function_for(normalize) builds the embedding function to attach; None attaches none.
+    """
+    try:
+        existing = client.get_collection(name=name)
+    except collection_not_found_errors():
+        existing = None
+    normalize = existing is None or is_unit_vector_collection(existing)
+    embedding_function = embedding_function_for(normalize) if embedding_function_for else None
+    if existing is None:
+        collection = client.get_or_create_collection(name=name, embedding_function=embedding_function,
+                                                     metadata=COLLECTION_METADATA)
+    else:
+        # Never pass metadata for an existing collection: Chroma refuses to change its space
+        collection = client.get_collection(name=name, embedding_function=embedding_function)
+    return collection, normalize
+
+
+# --- GUIDE KB STORAGE ---
+def sidecar_path(kb_path: Path) -> Path:
+    """gl_guide_kb.json -> gl_guide_kb.emb.npy"""
+    return kb_path.with_suffix(EMBEDDING_SIDECAR_SUFFIX)
+
+
+def load_kb_with_embeddings(kb_path: Path) -> list:
+    """
+    Loads a guide KB JSON and re-attaches each topic's embedding from the sidecar matrix.
+    Topics that still carry an inline "embedding" (e.g. freshly built from a PDF) keep it.
+    """
+    kb = orjson.loads(kb_path.read_bytes())
+    npy_path = sidecar_path(kb_path)
+    if npy_path.exists() and any("embedding" not in topic for topic in kb):
+        rows = np.load(npy_path).astype(np.float32).tolist()
+        for topic in kb:
+            row = topic.get("row")
+            if "embedding" not in topic and row is not None and 0 <= row < len(rows):
+                topic["embedding"] = rows[row]
+    return kb
+
+
+def save_kb_with_embeddings(kb_path: Path, kb: list):
+    """
+    Writes all embeddings to the float16 sidecar and the remaining topic fields (plus "row") to JSON.
+    Topics without an embedding are kept with "row": -1.
+    """
+    embedded = [topic["embedding"] for topic in kb if "embedding" in topic]
+    np.save(sidecar_path(kb_path), np.asarray(embedded, dtype=np.float16))
+    metadata, next_row = [], 0
+    for topic in kb:
+        row = -1
+        if "embedding" in topic:
+            row, next_row = next_row, next_row + 1
+        metadata.append({**{k: v for k, v in topic.items() if k != "embedding"}, "row": row})
+    kb_path.write_bytes(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+
+
+def iter_json_items(path):
+    """Yields the items of a top-level JSON array one at a time instead of loading the whole file."""
+    import ijson  # only the migration scripts stream JSON; the apps don't need ijson installed
+
+    with open(path, "rb") as f:
+        # use_float keeps numbers as float (not Decimal) so they stay valid Chroma metadata
+        yield from ijson.items(f, "item", use_float=True)
+
+
+# Exact-type set lookup is cheaper than an isinstance tuple check per key on large migrations
+_PRIMITIVE_TYPES = {str, int, float, bool}
+
+
+def coerce_metadata(obj):
+    """
+    Ensure metadata is JSON-serializable and simple (Chroma prefers flat types).
+    - Remove None keys
+    - Convert non-basic types to strings
+    """
+    if not isinstance(obj, dict):
+        return {}
+    out = {}
+    for k, v in obj.items():
+        if v is None:
+            continue
+        # orjson keeps non-ASCII as-is, like json.dumps(..., ensure_ascii=False)
+        out[k] = v if type(v) in _PRIMITIVE_TYPES else orjson.dumps(v).decode()
+    return out
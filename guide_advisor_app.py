@@ -1,9 +1,10 @@
 import streamlit as st
-import json
 import os
+import shutil
 from pathlib import Path
 from uuid import uuid4
-from sentence_transformers import SentenceTransformer
+
+from embeddings import get_sentence_model, load_kb_with_embeddings, save_kb_with_embeddings
 
 # --- CONFIGURATION ---
 BASE_DIR = Path(__file__).parent
@@ -37,10 +38,9 @@ st.info("Use this page to add new topics to the User Guide knowledge bases.")
 
 
 # --- HELPER FUNCTIONS ---
-@st.cache_resource
 def get_embedding_model():
-    """Loads the sentence transformer model."""
-    return SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+    """Returns the process-wide sentence transformer model."""
+    return get_sentence_model()
 
 
 # --- MODIFIED: This function now takes a path argument ---
@@ -50,8 +50,7 @@ def add_topic_to_guide_kb(new_topic: dict, target_kb_path: Path):
     """
     try:
         if target_kb_path.exists():
-            with open(target_kb_path, "r", encoding="utf-8") as f:
-                kb = json.load(f)
+            kb = load_kb_with_embeddings(target_kb_path)
         else:
             kb = []
 
@@ -62,8 +61,8 @@ def add_topic_to_guide_kb(new_topic: dict, target_kb_path: Path):
 
         kb.append(new_topic)
 
-        with open(target_kb_path, "w", encoding="utf-8") as f:
-            json.dump(kb, f, ensure_ascii=False, indent=2)
+        # Embeddings go to the .emb.npy sidecar; the JSON keeps only topic fields
+        save_kb_with_embeddings(target_kb_path, kb)
 
         return True
     except Exception as e:
@@ -119,8 +118,10 @@ with st.form("new_topic_form", clear_on_submit=True):
                     # --- MODIFIED: Use the dynamic image directory ---
                     image_path = target_img_dir / unique_filename
 
+                    # Stream in 1 MiB chunks instead of writing the whole buffer at once
+                    solution_image.seek(0)
                     with open(image_path, "wb") as f:
-                        f.write(solution_image.getbuffer())
+                        shutil.copyfileobj(solution_image, f, 1 << 20)
 
                     image_path_list.append(str(image_path))
                     st.info(f"Image saved to {image_path}")
@@ -1,17 +1,19 @@
 #!/usr/bin/env python
 import os
 import sys
-import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from uuid import uuid4
 
+import numpy as np
+import orjson
 import toml
 import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
 
-import chromadb.utils.embedding_functions
+from embeddings import (SentenceModelEmbeddingFunction, coerce_metadata, collection_not_found_errors,
+                        get_sentence_model, iter_json_items, open_collection)
+
 # --------------------
 # CONFIG & CONSTANTS
 # --------------------
@@ -19,12 +21,15 @@ BASE_DIR = Path(__file__).parent.resolve()
 CACHE_DIR = BASE_DIR / "cache"
 ERRORS_KB_PATH = CACHE_DIR / "gl_errors_kb.json"
 PENDING_KB_PATH = CACHE_DIR / "pending_solutions.json"
+LIVE_BACKUP_PATH = CACHE_DIR / "live_errors_kb.backup.json"  # written by --recreate before deleting
 
 LIVE_KB_COLLECTION = "live_errors_kb"
 PENDING_KB_COLLECTION = "pending_errors_kb"
 
 CHROMA_HOST_DEFAULT = "api.trychroma.com"
 BATCH_SIZE = 128  # tune as needed
+PROBE_SIZE = 1000  # ids per existence check when resuming
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
 
 # --------------------
 # SECRET LOADING
@@ -61,26 +66,24 @@ def load_secrets():
 # --------------------
 # CLIENT & MODEL
 # --------------------
-_model = None
 _client = None
 
 def get_embedding_model():
-    global _model
-    if _model is None:
-        # multilingual, small, fast
-        _model = SentenceTransformer("paraphrase-multilingual-MiniLM-L12-v2")
-    return _model
+    # multilingual, small, fast; one shared instance per process
+    return get_sentence_model()
 
-# In migrate.py
 def get_chroma_client(secrets):
     global _client
     if _client is None:
+        # Same client the apps use (db_utils.get_chroma_client)
         _client = chromadb.CloudClient(
             api_key=secrets["CHROMA_API_KEY"],
             tenant=secrets["CHROMA_TENANT"],
-            database=secrets["CHROMA_DATABASE"]
+            database=secrets["CHROMA_DATABASE"],
+            cloud_host=secrets["CHROMA_HOST"],
         )
     return _client
+
 # --------------------
 # UTIL
 # --------------------
@@ -94,332 +97,185 @@ def chunked(iterable, size):
     if buf:
         yield buf
 
-def coerce_metadata(obj):
+def supports_process_pool(model):
     """
-    Ensure metadata is JSON-serializable and simple (Chroma prefers flat types).
-    - Remove None keys
-    - Convert non-basic types to strings
+    Only the plain PyTorch SentenceTransformer is sharded across processes. CT2SentenceTransformer
+    subclasses it but runs its own CTranslate2 runtime, and the ONNX encoder has no pool at all.
     """
-    if not isinstance(obj, dict):
-        return {}
-    out = {}
-    for k, v in obj.items():
-        if v is None:
-            continue
-        if isinstance(v, (str, int, float, bool)):
-            out[k] = v
-        else:
-            out[k] = json.dumps(v, ensure_ascii=False)
-    return out
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        return False
+    return type(model) is SentenceTransformer
 
 # --------------------
 # MIGRATION
 # --------------------
-def migrate_live(client, model):
-    total = 0
-    ok = 0
-    skipped = 0
+def migrate_live(live_collection, model, workers=1, force=False, normalize=True):
+    """
+    Migrates data from gl_errors_kb.json to the live ChromaDB collection.
+    IDs already in the collection are skipped unless force is set, so an interrupted run can resume.
+    With workers > 1 (SentenceTransformer backend only) everything is encoded up front on a process pool.
+    normalize must match the collection (see embeddings.open_collection).
+    """
+    ok, skipped, total = 0, 0, 0
 
     if not ERRORS_KB_PATH.exists():
         print("SKIPPED: gl_errors_kb.json not found.")
         return (ok, skipped, total)
 
-    live = client.get_or_create_collection(name=LIVE_KB_COLLECTION)
-
-    with open(ERRORS_KB_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    total = len(data)
-    print(f"Found {total} LIVE items. Embedding & upserting in batches of {BATCH_SIZE}...")
-
-    for batch in chunked(data, BATCH_SIZE):
-        ids, embeddings, metadatas = [], [], []
-        texts = []
-
-        for item in batch:
-            try:
-                # sanitize / prepare
-                item = dict(item)
-                item.pop("embedding", None)
-                item.pop("review_id", None)  # remove noisy field if present
-
-                msg_no = item.get("message_number")
-                if msg_no is None:
-                    raise ValueError("missing message_number")
-
-                text = f"{item.get('message_text', '')} {item.get('reason', '')}".strip()
-                if not text:
-                    # minimally embed something stable to keep record
-                    text = f"Message #{msg_no}"
-
-                texts.append(text)
-                ids.append(str(msg_no))
-                metadatas.append(coerce_metadata(item))
-            except Exception as e:
-                skipped += 1
-                print(f"  > SKIPPED #{item.get('message_number', 'N/A')}: {e}")
+    # Stream items off disk so only the extracted texts/metadata are held, not the parsed file
+    ids, texts, metadatas = [], [], []
+    for item in iter_json_items(ERRORS_KB_PATH):
+        total += 1
+        try:
+            item = dict(item)
+            # This is the critical fix to prevent the quota error
+            item.pop("embedding", None)
+            item.pop("review_id", None)  # leftover from the review queue, not live metadata
 
-        if not ids:
-            continue
+            msg_no = item.get("message_number")
+            if msg_no is None:
+                raise ValueError("missing message_number")
 
-        try:
-            vecs = model.encode(texts, convert_to_numpy=True).tolist()
-            embeddings.extend(vecs)
+            text = f"{item.get('message_text', '')} {item.get('reason', '')}".strip() or f"Message #{msg_no}"
 
-            # upsert = create or replace existing ids
-            live.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas)
-            ok += len(ids)
-            print(f"  > Upserted {len(ids)} items (last id: {ids[-1]})")
+            texts.append(text)
+            ids.append(str(msg_no))
+            metadatas.append(coerce_metadata(item))
         except Exception as e:
-            skipped += len(ids)
-            print(f"  > BATCH FAILED ({len(ids)} items). Reason: {e}")
-
-    return (ok, skipped, total)
+            skipped += 1
+            print(f"  > SKIPPED item. Reason: {e}")
 
-def migrate_pending(client):
-    total = 0
-    ok = 0
-    skipped = 0
+    print(f"Found {total} LIVE items. Embedding & upserting in batches of {BATCH_SIZE}...")
 
-    if not PENDING_KB_PATH.exists():
-        print("SKIPPED: pending_solutions.json not found.")
+    if not ids:
         return (ok, skipped, total)
 
-    pending = client.get_or_create_collection(name=PENDING_KB_COLLECTION)
-
-    with open(PENDING_KB_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    total = len(data)
-    print(f"Found {total} PENDING items. Upserting (no embeddings)...")
-
-    for batch in chunked(data, BATCH_SIZE):
-        ids, metadatas = [], []
-        for item in batch:
-            try:
-                review_id = item.get("review_id") or f"review_{uuid4().hex[:8]}"
-                ids.append(str(review_id))
-                metadatas.append(coerce_metadata(item))
-            except Exception as e:
-                skipped += 1
-                print(f"  > SKIPPED pending item: {e}")
-
-        if not ids:
-            continue
-
+    if not force:
+        # include=[] returns just the ids, without metadatas or embeddings
+        existing = set()
+        for id_batch in chunked(ids, PROBE_SIZE):
+            existing.update(live_collection.get(ids=id_batch, include=[])["ids"])
+        if existing:
+            keep = [i for i, item_id in enumerate(ids) if item_id not in existing]
+            ok += len(ids) - len(keep)
+            print(f"  > {len(ids) - len(keep)} items already migrated, skipping (use --force to re-embed them)")
+            ids = [ids[i] for i in keep]
+            texts = [texts[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+            if not ids:
+                return (ok, skipped, total)
+
+    def settle(batch_ids, future):
+        nonlocal ok, skipped
         try:
-            # upsert without embeddings is fine for metadata-only
-            pending.upsert(ids=ids, metadatas=metadatas)
-            ok += len(ids)
-            print(f"  > Upserted {len(ids)} pending items (last id: {ids[-1]})")
+            future.result()
+            ok += len(batch_ids)
+            print(f"  > Upserted {len(batch_ids)} items (last id: {batch_ids[-1]})")
         except Exception as e:
-            skipped += len(ids)
-            print(f"  > PENDING BATCH FAILED ({len(ids)} items). Reason: {e}")
+            skipped += len(batch_ids)
+            print(f"  > BATCH FAILED ({len(batch_ids)} items). Reason: {e}")
 
-    return (ok, skipped, total)
-
-# --------------------
-# MAIN
-# --------------------
-def main():
-    parser = argparse.ArgumentParser(description="Migrate local KB JSON files to Chroma Cloud.")
-    parser.add_argument("--host", default=os.getenv("CHROMA_HOST", CHROMA_HOST_DEFAULT), help="Chroma host")
-    args = parser.parse_args()
-
-    secrets = load_secrets()
-    secrets["CHROMA_HOST"] = args.host or secrets.get("CHROMA_HOST", CHROMA_HOST_DEFAULT)
-
-    print("--- Connecting to ChromaDB Cloud ---")
-    client = get_chroma_client(secrets)
-    model = get_embedding_model()
-    print(f"--- Connected. Tenant={secrets['CHROMA_TENANT']} Database={secrets['CHROMA_DATABASE']} Host={secrets['CHROMA_HOST']} ---")
-
-    print("\n--- Migrating LIVE Knowledge Base ---")
-    ok_l, sk_l, tot_l = migrate_live(client, model)
-    print(f"LIVE: {ok_l}/{tot_l} upserted, {sk_l} skipped.")
-
-    print("\n--- Migrating PENDING Solutions ---")
-    ok_p, sk_p, tot_p = migrate_pending(client)
-    print(f"PENDING: {ok_p}/{tot_p} upserted, {sk_p} skipped.")
-
-    print("\n✅ All migrations finished.")
-
-if __name__ == "__main__":
-    sys.exit(main())
-#!/usr/bin/env python
-import os
-import sys
-import json
-import argparse
-from pathlib import Path
-from uuid import uuid4
-
-import toml
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-
-# --------------------
-# CONFIG & CONSTANTS
-# --------------------
-BASE_DIR = Path(__file__).parent.resolve()
-CACHE_DIR = BASE_DIR / "cache"
-ERRORS_KB_PATH = CACHE_DIR / "gl_errors_kb.json"
-PENDING_KB_PATH = CACHE_DIR / "pending_solutions.json"
-
-LIVE_KB_COLLECTION = "live_errors_kb"
-PENDING_KB_COLLECTION = "pending_errors_kb"
-
-CHROMA_HOST_DEFAULT = "api.trychroma.com"
-BATCH_SIZE = 128  # tune as needed
+    # Walk the items shortest-first so each encode batch pads to similar lengths (upsert order
+    # doesn't matter), and upload batch N on a worker thread while batch N+1 is being encoded.
+    order = np.argsort([len(t) for t in texts], kind="stable")
 
-# --------------------
-# SECRET LOADING
-# --------------------
-def load_secrets():
-    """Return dict with CHROMA_* from env or .streamlit/secrets.toml."""
-    secrets = {
-        "CHROMA_API_KEY": os.getenv("CHROMA_API_KEY"),
-        "CHROMA_TENANT": os.getenv("CHROMA_TENANT"),
-        "CHROMA_DATABASE": os.getenv("CHROMA_DATABASE"),
-        "CHROMA_HOST": os.getenv("CHROMA_HOST", CHROMA_HOST_DEFAULT),
-    }
+    sorted_vecs = None
+    if workers > 1 and supports_process_pool(model):
+        print(f"Encoding {len(order)} items on {workers} worker processes...")
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+        try:
+            sorted_vecs = model.encode_multi_process([texts[i] for i in order], pool,
+                                                     batch_size=64, chunk_size=1024,
+                                                     normalize_embeddings=normalize)
+        finally:
+            model.stop_multi_process_pool(pool)
+
+    in_flight = None
+    with ThreadPoolExecutor(max_workers=1) as uploader:
+        for start in range(0, len(order), BATCH_SIZE):
+            idx = order[start:start + BATCH_SIZE]
+            batch_ids = [ids[i] for i in idx]
+            try:
+                if sorted_vecs is not None:
+                    vecs = sorted_vecs[start:start + BATCH_SIZE]
+                else:
+                    vecs = model.encode([texts[i] for i in idx], batch_size=BATCH_SIZE, convert_to_numpy=True,
+                                         normalize_embeddings=normalize)
+            except Exception as e:
+                skipped += len(batch_ids)
+                print(f"  > ENCODING FAILED ({len(batch_ids)} items). Reason: {e}")
+                continue
 
-    if all(secrets[k] for k in ("CHROMA_API_KEY", "CHROMA_TENANT", "CHROMA_DATABASE")):
-        return secrets
+            # Rounded to fp16 precision: the shorter float reprs shrink the JSON upload.
+            # Chroma stores float32 either way and accepts the ndarray as-is (no .tolist() copy).
+            vecs = vecs.astype(np.float16).astype(np.float32)
 
-    # Fallback to local secrets.toml
-    secrets_path = BASE_DIR / ".streamlit" / "secrets.toml"
-    if secrets_path.exists():
-        file_secrets = toml.load(secrets_path)
-        for k in ("CHROMA_API_KEY", "CHROMA_TENANT", "CHROMA_DATABASE"):
-            secrets[k] = secrets[k] or file_secrets.get(k)
-        secrets["CHROMA_HOST"] = secrets["CHROMA_HOST"] or file_secrets.get("CHROMA_HOST", CHROMA_HOST_DEFAULT)
+            # At most one upload in flight: wait for the previous one before queueing this one
+            if in_flight:
+                settle(*in_flight)
+            future = uploader.submit(live_collection.upsert, ids=batch_ids,
+                                     embeddings=vecs,
+                                     metadatas=[metadatas[i] for i in idx])
+            in_flight = (batch_ids, future)
 
-    missing = [k for k in ("CHROMA_API_KEY", "CHROMA_TENANT", "CHROMA_DATABASE") if not secrets.get(k)]
-    if missing:
-        raise SystemExit(
-            "Missing required secrets: "
-            + ", ".join(missing)
-            + "\nProvide via environment or .streamlit/secrets.toml"
-        )
-    return secrets
+        if in_flight:
+            settle(*in_flight)
 
-# --------------------
-# CLIENT & MODEL
-# --------------------
-_model = None
-_client = None
+    return (ok, skipped, total)
 
-def get_embedding_model():
-    global _model
-    if _model is None:
-        # multilingual, small, fast
-        _model = SentenceTransformer("paraphrase-multilingual-MiniLM-L12-v2")
-    return _model
 
-def get_chroma_client(secrets):
-    global _client
-    if _client is None:
-        _client = chromadb.Client(
-            Settings(
-                chroma_api_impl="chromadb.api.cloud",
-                chroma_server_host=secrets["CHROMA_HOST"],
-                chroma_server_ssl=True,
-                api_key=secrets["CHROMA_API_KEY"],
-                tenant=secrets["CHROMA_TENANT"],
-                database=secrets["CHROMA_DATABASE"],
-            )
-        )
-    return _client
+def snapshot_collection(collection):
+    """Reads every (id, metadata) from a collection in limit/offset pages, like db_utils._get_all_metadatas."""
+    ids, metadatas = [], []
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=PROBE_SIZE, offset=offset)
+        page_ids = page.get("ids") or []
+        ids.extend(page_ids)
+        metadatas.extend(page.get("metadatas") or [])
+        if len(page_ids) < PROBE_SIZE:
+            return ids, metadatas
+        offset += PROBE_SIZE
 
-# --------------------
-# UTIL
-# --------------------
-def chunked(iterable, size):
-    buf = []
-    for x in iterable:
-        buf.append(x)
-        if len(buf) >= size:
-            yield buf
-            buf = []
-    if buf:
-        yield buf
 
-def coerce_metadata(obj):
+def recreate_live(client, model):
     """
-    Ensure metadata is JSON-serializable and simple (Chroma prefers flat types).
-    - Remove None keys
-    - Convert non-basic types to strings
+    Rebuilds the live collection with inner-product space without losing what only exists in Chroma
+    (solutions approved in admin_app are never written back to gl_errors_kb.json).
+    Every record is first saved to LIVE_BACKUP_PATH, then re-embedded from its metadata into the new
+    collection; migrate_live afterwards only adds JSON items the old collection didn't have.
     """
-    if not isinstance(obj, dict):
-        return {}
-    out = {}
-    for k, v in obj.items():
-        if v is None:
-            continue
-        if isinstance(v, (str, int, float, bool)):
-            out[k] = v
-        else:
-            out[k] = json.dumps(v, ensure_ascii=False)
-    return out
+    try:
+        old_collection = client.get_collection(name=LIVE_KB_COLLECTION)
+    except collection_not_found_errors():
+        print(f"--- {LIVE_KB_COLLECTION} does not exist yet; nothing to recreate ---")
+        return
+    ids, metadatas = snapshot_collection(old_collection)
+    LIVE_BACKUP_PATH.write_bytes(orjson.dumps([{"id": i, "metadata": m} for i, m in zip(ids, metadatas)],
+                                              option=orjson.OPT_INDENT_2))
+    print(f"--- Saved {len(ids)} live records to {LIVE_BACKUP_PATH.name} ---")
+
+    client.delete_collection(name=LIVE_KB_COLLECTION)
+    new_collection, normalize = open_collection(client, LIVE_KB_COLLECTION)
+    print(f"--- Recreated {LIVE_KB_COLLECTION} with inner-product space; re-embedding its records ---")
+
+    restored = 0
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch_ids = ids[start:start + BATCH_SIZE]
+        batch_meta = [m or {} for m in metadatas[start:start + BATCH_SIZE]]
+        texts = [f"{m.get('message_text', '')} {m.get('reason', '')}".strip() or f"Message #{i}"
+                 for i, m in zip(batch_ids, batch_meta)]
+        vecs = model.encode(texts, batch_size=BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=normalize)
+        # Failures propagate: the backup file is the way back, and a rerun would otherwise read an empty collection
+        new_collection.upsert(ids=batch_ids, embeddings=vecs.astype(np.float16).astype(np.float32),
+                              metadatas=batch_meta)
+        restored += len(batch_ids)
+    print(f"--- Re-embedded {restored}/{len(ids)} live records. Restart running apps: they cache the handle "
+          "to the deleted collection (db_utils.get_collection) ---")
 
-# --------------------
-# MIGRATION
-# --------------------
-def migrate_live(live_collection, model):
-    """Migrates data from gl_errors_kb.json to the live ChromaDB collection."""
-    ok, skipped, total = 0, 0, 0
-
-    if not ERRORS_KB_PATH.exists():
-        print("SKIPPED: gl_errors_kb.json not found.")
-        return (ok, skipped, total)
 
-    with open(ERRORS_KB_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    total = len(data)
-    print(f"Found {total} LIVE items. Embedding & upserting in batches of {BATCH_SIZE}...")
-
-    for batch in chunked(data, BATCH_SIZE):
-        ids, embeddings, metadatas, texts = [], [], [], []
-
-        for item in batch:
-            try:
-                item = dict(item)
-                # This is the critical fix to prevent the quota error
-                item.pop("embedding", None)
-
-                msg_no = item.get("message_number")
-                if not msg_no:
-                    raise ValueError("missing message_number")
-
-                text = f"{item.get('message_text', '')} {item.get('reason', '')}".strip() or f"Message #{msg_no}"
-
-                texts.append(text)
-                ids.append(str(msg_no))
-                metadatas.append(coerce_metadata(item))
-            except Exception as e:
-                skipped += 1
-                print(f"  > SKIPPED item in batch. Reason: {e}")
-
-        if not ids:
-            continue
-
-        try:
-            # Generate new embeddings
-            vecs = model.encode(texts, convert_to_numpy=True).tolist()
-            embeddings.extend(vecs)
-
-            # Upsert the batch to ChromaDB
-            live_collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas)
-            ok += len(ids)
-            print(f"  > Upserted {len(ids)} items (last id: {ids[-1]})")
-        except Exception as e:
-            skipped += len(ids)
-            print(f"  > BATCH FAILED ({len(ids)} items). Reason: {e}")
-
-    return (ok, skipped, total)
 def migrate_pending(pending_collection):
     """Migrates data from pending_solutions.json to the pending ChromaDB collection."""
     ok, skipped, total = 0, 0, 0
@@ -428,20 +284,21 @@ def migrate_pending(pending_collection):
         print("SKIPPED: pending_solutions.json not found.")
         return (ok, skipped, total)
 
-    with open(PENDING_KB_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    total = len(data)
-    print(f"Found {total} PENDING items. Upserting in batches of {BATCH_SIZE}...")
+    print(f"Upserting PENDING items in batches of {BATCH_SIZE}...")
 
-    for batch in chunked(data, BATCH_SIZE):
-        ids, metadatas = [], []
+    # Batches are upserted as they are parsed; the total is only known at the end
+    for batch in chunked(iter_json_items(PENDING_KB_PATH), BATCH_SIZE):
+        total += len(batch)
+        ids, metadatas, documents = [], [], []
         for item in batch:
             try:
                 # Ensure a review_id exists
                 review_id = item.get("review_id") or f"review_{uuid4().hex[:8]}"
                 ids.append(str(review_id))
                 metadatas.append(coerce_metadata(item))
+                # Same document text as db_utils.batch_submit_for_review; Chroma rejects upserts
+                # that carry neither documents nor embeddings
+                documents.append(f"Error {item.get('message_number', '')}: {item.get('message_text', '')}")
             except Exception as e:
                 skipped += 1
                 print(f"  > SKIPPED pending item in batch. Reason: {e}")
@@ -450,8 +307,7 @@ def migrate_pending(pending_collection):
             continue
 
         try:
-            # Upsert batch of pending items (metadata only)
-            pending_collection.upsert(ids=ids, metadatas=metadatas)
+            pending_collection.upsert(ids=ids, metadatas=metadatas, documents=documents)
             ok += len(ids)
             print(f"  > Upserted {len(ids)} pending items (last id: {ids[-1]})")
         except Exception as e:
@@ -459,10 +315,23 @@ def migrate_pending(pending_collection):
             print(f"  > PENDING BATCH FAILED ({len(ids)} items). Reason: {e}")
 
     return (ok, skipped, total)
+
 # --------------------
 # MAIN
 # --------------------
 def main():
+    parser = argparse.ArgumentParser(description="Migrate the local JSON knowledge bases to ChromaDB Cloud.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Encoder processes for the live KB (1 = encode in this process).")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-embed and upsert live items that are already in the collection.")
+    parser.add_argument("--recreate", action="store_true",
+                        help="Rebuild the live collection, e.g. to move an old l2 collection to inner product "
+                             "over normalized vectors. Existing records (including approved solutions) are "
+                             f"backed up to cache/{LIVE_BACKUP_PATH.name} and re-embedded. Restart the apps "
+                             "afterwards.")
+    args = parser.parse_args()
+
     secrets = load_secrets()
 
     print("--- Connecting to ChromaDB Cloud ---")
@@ -470,18 +339,21 @@ def main():
     model = get_embedding_model()
     print(f"--- Connected. Tenant={secrets['CHROMA_TENANT']}, Database={secrets['CHROMA_DATABASE']} ---")
 
-    # Define the embedding function that our collections will use
-    embedding_func = chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="paraphrase-multilingual-MiniLM-L12-v2"
-    )
+    if args.recreate:
+        recreate_live(client, model)
 
-    # Get or create the collections, ensuring they use the correct embedding function
-    live_collection = client.get_or_create_collection(name=LIVE_KB_COLLECTION, embedding_function=embedding_func)
-    pending_collection = client.get_or_create_collection(name=PENDING_KB_COLLECTION, embedding_function=embedding_func)
+    # The live KB is upserted with pre-computed embeddings only, so no embedding function is attached
+    # and Chroma never re-embeds; the pending KB sends documents and gets the app's function.
+    live_collection, normalize_live = open_collection(client, LIVE_KB_COLLECTION)
+    pending_collection, _ = open_collection(client, PENDING_KB_COLLECTION, SentenceModelEmbeddingFunction)
+    if not normalize_live:
+        print(f"NOTE: {LIVE_KB_COLLECTION} still uses l2 over raw vectors; run with --recreate to switch it "
+              "to inner product (approved solutions are kept), then restart the apps.")
 
     print("\n--- Migrating LIVE Knowledge Base ---")
     # Pass the collection objects directly to the functions
-    ok_l, sk_l, tot_l = migrate_live(live_collection, model)
+    ok_l, sk_l, tot_l = migrate_live(live_collection, model, workers=args.workers, force=args.force,
+                                     normalize=normalize_live)
     print(f"LIVE: {ok_l}/{tot_l} upserted, {sk_l} skipped.")
 
     print("\n--- Migrating PENDING Solutions ---")
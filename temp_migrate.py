@@ -1,9 +1,15 @@
-import json
-import toml  # A library for reading .toml files
+import hashlib
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
-from uuid import uuid4
-import chromadb.cloud
-from sentence_transformers import SentenceTransformer
+import numpy as np
+
+from embeddings import (MODEL_NAME, OnnxSentenceEncoder, SentenceModelEmbeddingFunction, coerce_metadata,
+                        get_sentence_model, is_unit_vector_collection, iter_json_items, open_collection)
+
+# Let the Rust tokenizer use its threads; this script never forks after tokenizing
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
 
 # --- STEP 1: Manually define your secrets here for the script ---
 # You can copy these directly from your .streamlit/secrets.toml file
@@ -20,14 +26,35 @@ ERRORS_KB_PATH = CACHE_DIR / "gl_errors_kb.json"
 PENDING_KB_PATH = CACHE_DIR / "pending_solutions.json"
 LIVE_KB_COLLECTION = "live_errors_kb"
 PENDING_KB_COLLECTION = "pending_errors_kb"
+UPLOAD_BATCH_SIZE = 200  # records per Chroma request
+CPU_ENCODE_THREADS = min(os.cpu_count() or 1, 8)  # sentence-transformers stops scaling past ~8 cores
+EMBEDDING_CACHE_PATH = CACHE_DIR / "migration_embeddings.npz"  # text hash -> vector, reused across runs
 
 
 # --- HELPER FUNCTIONS (No Streamlit dependencies) ---
 def get_embedding_model():
-    return SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+    """
+    The apps' model (embeddings.get_sentence_model, chosen by EMBEDDING_BACKEND), so the vectors
+    written here come from the same runtime that later queries and appends to the collections.
+    """
+    import torch
+    torch.set_num_threads(CPU_ENCODE_THREADS)  # only the PyTorch backend reads this
+    return get_sentence_model()
+
+
+def encode(model, texts, normalize: bool, **kwargs):
+    """
+    model.encode without autograd bookkeeping; the migration is inference only.
+    With normalize, vectors come back unit-length, normalized once here instead of at query time;
+    it must match the target collection (see embeddings.open_collection).
+    """
+    import torch
+    with torch.inference_mode():
+        return model.encode(texts, convert_to_numpy=True, normalize_embeddings=normalize, **kwargs)
 
 
 def get_chroma_client():
+    import chromadb.cloud
     return chromadb.cloud.HttpClient(
         api_key=CHROMA_API_KEY,
         tenant=CHROMA_TENANT,
@@ -35,67 +62,217 @@ def get_chroma_client():
     )
 
 
+def is_valid_error(item) -> bool:
+    """Same required fields as the admin form; checked before any model work is spent on the item."""
+    return (isinstance(item, dict) and isinstance(item.get("message_number"), (int, str))
+            and str(item["message_number"]).strip() != ""
+            and bool(item.get("message_text")) and bool(item.get("reason")))
+
+
+def embedding_text(item: dict) -> str:
+    return f"{item.get('message_text', '')} {item.get('reason', '')}".strip()
+
+
 def approve_solution_db(solution: dict, live_collection):
     solution.pop("review_id", None)
     model = get_embedding_model()
-    text_to_embed = f"{solution.get('message_text', '')
-    } {solution.get('reason', '')}"
-    embedding = model.encode(text_to_embed).tolist()
+    text_to_embed = embedding_text(solution)
+    # (1, dim) float32 array: the client serializes it without a list-of-floats detour
+    embeddings = to_upload_precision(encode(model, [text_to_embed], is_unit_vector_collection(live_collection)))
 
     live_collection.add(
         ids=[str(solution["message_number"])],
-        embeddings=[embedding],
+        embeddings=embeddings,
         metadatas=[solution]
     )
 
 
+def new_review_ids(count: int) -> list:
+    """`count` ids in the usual review_<8 hex> format from a single entropy read."""
+    token = secrets.token_hex(4 * count)
+    return [f"review_{token[i:i + 8]}" for i in range(0, 8 * count, 8)]
+
+
+def pending_document(item: dict) -> str:
+    """Same document text as db_utils.batch_submit_for_review and migrate.migrate_pending."""
+    return f"Error {item.get('message_number', '')}: {item.get('message_text', '')}"
+
+
 def submit_solution_for_review_db(solution: dict, pending_collection):
-    solution["review_id"] = f"review_{uuid4().hex[:8]}"
+    solution["review_id"] = new_review_ids(1)[0]
+    # Chroma rejects adds with neither documents nor embeddings; the collection's function embeds the document
     pending_collection.add(
         ids=[solution["review_id"]],
-        metadatas=[solution]
+        documents=[pending_document(solution)],
+        metadatas=[coerce_metadata(solution)]
     )
 
 
-# --- MIGRATION LOGIC ---
-def migrate():
-    print("--- Connecting to ChromaDB... ---")
-    client = get_chroma_client()
-    live_collection = client.get_or_create_collection(name=LIVE_KB_COLLECTION)
-    pending_collection = client.get_or_create_collection(name=PENDING_KB_COLLECTION)
-    print("--- Connection successful. ---")
+# --- EMBEDDING CACHE ---
+def _runtime_tag(model) -> str:
+    """Backend, device and weight precision: ONNX-int8 and CUDA-fp16 vectors differ from fp32 ones."""
+    if isinstance(model, OnnxSentenceEncoder):
+        return "onnx-int8/cpu"
+    if type(model).__name__ == "CT2SentenceTransformer":
+        return "ct2-int8/cpu"  # the compute_type/device embeddings.load_sentence_model uses
+    dtype = str(next(model.parameters()).dtype).replace("torch.", "")
+    return f"{type(model).__name__}/{model.device}/{dtype}"
+
+
+def _cache_key(text: str, runtime: str, normalize: bool) -> str:
+    # Whitespace is collapsed but case is kept: the model's tokenizer is cased.
+    # Unit-length and raw vectors of the same text are cached separately.
+    collapsed = " ".join(text.split())
+    kind = "unit" if normalize else "raw"
+    key = f"{MODEL_NAME}\0{runtime}\0{kind}\0{collapsed}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def load_embedding_cache() -> dict:
+    if not EMBEDDING_CACHE_PATH.exists():
+        return {}
+    with np.load(EMBEDDING_CACHE_PATH) as data:
+        return dict(zip(data["keys"].tolist(), data["vectors"]))
+
+
+def save_embedding_cache(cache: dict):
+    if cache:
+        np.savez(EMBEDDING_CACHE_PATH, keys=np.array(list(cache)),
+                 vectors=np.stack(list(cache.values())).astype(np.float32))
 
-    # Migrate Live KB
+
+def encode_cached(model, texts, cache: dict, normalize: bool):
+    """
+    Encodes only texts not seen before (deduplicated), then serves every row from the cache.
+    Returns a (len(texts), dim) float32 array.
+    """
+    runtime = _runtime_tag(model)
+    keys = [_cache_key(t, runtime, normalize) for t in texts]
+    misses = {}
+    for key, text in zip(keys, texts):
+        if key not in cache:
+            misses.setdefault(key, text)
+    if misses:
+        vectors = encode(model, list(misses.values()), normalize, batch_size=64)
+        cache.update(zip(misses, vectors.astype(np.float32)))
+    return np.stack([cache[key] for key in keys])
+
+
+def to_upload_precision(vectors):
+    """
+    Rounds to fp16 precision. Chroma stores float32, so int8 codes would need a server-side
+    dequantize step it doesn't have; fp16-rounded values still shorten the JSON payload.
+    """
+    return vectors.astype(np.float16).astype(np.float32)
+
+
+def chunks(iterable, size):
+    """Yields (start offset, list) batches from any iterable, including streamed JSON items."""
+    start, batch = 0, []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield start, batch
+            start, batch = start + size, []
+    if batch:
+        yield start, batch
+
+
+def existing_ids(collection, ids) -> set:
+    """IDs already in the collection; include=[] returns ids only, no metadata or vectors."""
+    found = set()
+    for _, batch_ids in chunks(ids, UPLOAD_BATCH_SIZE):
+        found.update(collection.get(ids=batch_ids, include=[])["ids"])
+    return found
+
+
+def add_batch(collection, ids, **columns):
+    try:
+        collection.add(ids=ids, **columns)
+        print(f"  > Migrated {len(ids)} items (last id: {ids[-1]})")
+    except Exception as e:
+        print(f"  > SKIPPED {len(ids)} items. Reason: {e}")
+
+
+# --- MIGRATION LOGIC ---
+def migrate_live(live_collection, normalize: bool):
     print("\n--- Migrating LIVE Knowledge Base (gl_errors_kb.json) ---")
     if ERRORS_KB_PATH.exists():
-        with open(ERRORS_KB_PATH, "r", encoding="utf-8") as f:
-            kb_data = json.load(f)
-        for item in kb_data:
-            try:
-                approve_solution_db(item, live_collection)
-                print(f"  > Migrated error #{item['message_number']}")
-            except Exception as e:
-                print(f"  > SKIPPED #{item['message_number']}. Reason: {e}")
+        metadatas, invalid = [], 0
+        for item in iter_json_items(ERRORS_KB_PATH):
+            if not is_valid_error(item):
+                invalid += 1
+                continue
+            item.pop("review_id", None)
+            # Old inline vectors are dropped while streaming: they're the bulk of the file and
+            # aren't valid Chroma metadata anyway
+            item.pop("embedding", None)
+            metadatas.append(item)
+        if invalid:
+            print(f"  > SKIPPED {invalid} items missing message_number, message_text or reason.")
+
+        # Re-runs only embed and add what a previous run didn't get to
+        already_migrated = existing_ids(live_collection, [str(item["message_number"]) for item in metadatas])
+        if already_migrated:
+            print(f"  > {len(already_migrated)} errors already migrated, skipping them")
+            metadatas = [item for item in metadatas if str(item["message_number"]) not in already_migrated]
+
+        texts = [embedding_text(item) for item in metadatas]
+        # Shortest-first so each encode batch pads to similar lengths; ids and metadata move with
+        # their text, so nothing needs to be permuted back before the add
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        metadatas = [metadatas[i] for i in order]
+        texts = [texts[i] for i in order]
+        ids = [str(item["message_number"]) for item in metadatas]
+
+        if ids:
+            model = get_embedding_model()
+            embedding_cache = load_embedding_cache()
+            # Batched encodes on this thread; each batch is uploaded on a worker while the next one encodes
+            with ThreadPoolExecutor(max_workers=2) as uploader:
+                futures = []
+                for start, batch_ids in chunks(ids, UPLOAD_BATCH_SIZE):
+                    end = start + UPLOAD_BATCH_SIZE
+                    embeddings = to_upload_precision(encode_cached(model, texts[start:end], embedding_cache, normalize))
+                    futures.append(uploader.submit(add_batch, live_collection, batch_ids,
+                                                   embeddings=embeddings, metadatas=metadatas[start:end]))
+                wait(futures)
+            save_embedding_cache(embedding_cache)
     else:
         print("SKIPPED: gl_errors_kb.json not found.")
 
-    # Migrate Pending KB
+
+def migrate_pending(pending_collection):
     print("\n--- Migrating PENDING Solutions (pending_solutions.json) ---")
     if PENDING_KB_PATH.exists():
-        with open(PENDING_KB_PATH, "r", encoding="utf-8") as f:
-            pending_data = json.load(f)
-        for item in pending_data:
-            try:
-                submit_solution_for_review_db(item, pending_collection)
-                print(f"  > Migrated pending item #{item.get('message_number', 'N/A')}")
-            except Exception as e:
-                print(f"  > SKIPPED pending item. Reason: {e}")
+        # Nothing here needs the whole list, so each batch is uploaded as soon as it is parsed
+        for _, batch in chunks(iter_json_items(PENDING_KB_PATH), UPLOAD_BATCH_SIZE):
+            ids = new_review_ids(len(batch))
+            for item, review_id in zip(batch, ids):
+                item["review_id"] = review_id
+            add_batch(pending_collection, ids, documents=[pending_document(item) for item in batch],
+                      metadatas=[coerce_metadata(item) for item in batch])
     else:
         print("SKIPPED: pending_solutions.json not found.")
 
 
+def migrate():
+    print("--- Connecting to ChromaDB... ---")
+    client = get_chroma_client()
+    # New collections get the shared inner-product space; existing l2 ones keep raw vectors
+    live_collection, normalize_live = open_collection(client, LIVE_KB_COLLECTION)
+    # Pending items go up as documents, embedded by the same function the apps attach
+    pending_collection, _ = open_collection(client, PENDING_KB_COLLECTION, SentenceModelEmbeddingFunction)
+    print("--- Connection successful. ---")
+
+    # The phases share only the model: LIVE is encode-bound, PENDING is small and mostly upload, so run them side by side
+    with ThreadPoolExecutor(max_workers=2) as phases:
+        futures = [phases.submit(migrate_live, live_collection, normalize_live),
+                   phases.submit(migrate_pending, pending_collection)]
+        for future in futures:
+            future.result()
+
+
 if __name__ == "__main__":
-    # You might need to install the toml library
-    # pip install toml
     migrate()
     print("\n✅ All migrations finished.")
\ No newline at end of file
@@ -9,6 +9,8 @@ from langchain.prompts import PromptTemplate
 from dotenv import load_dotenv
 import re
 
+from embeddings import load_kb_with_embeddings
+
 # --- CONFIGURATION ---
 load_dotenv()
 BASE_DIR = Path(__file__).parent
@@ -62,8 +64,10 @@ def transform_knowledge_base():
         print("Please run the 'Build GL User Guide' process in the Streamlit app first.")
         return
 
-    with open(RAW_KB_PATH, "r", encoding="utf-8") as f:
-        raw_sections = json.load(f)
+    # Embeddings live in the float16 sidecar next to the JSON; re-attach them so the output keeps them inline
+    raw_sections = load_kb_with_embeddings(RAW_KB_PATH)
+    for section in raw_sections:
+        section.pop("row", None)
 
     print(f"Loaded {len(raw_sections)} raw sections. Starting AI enrichment process...")
 